@@ -2,17 +2,24 @@
 
 import cortex
 import synth
-import sys
+import limits
 import random
 import argparse
 import time
 
-def save_random_sequence(size, number, duration, path, mode=None):
+def save_random_sequence(size, number, duration, path, mode=None, fused=False,
+                         supersample=1, max_bytes=None):
     if mode is None:
         mode = random.choice(["RGB", "HSV", "YCbCr", "CMYK"])
+    limits.check_scene(size, number, synth.modes[mode], max_bytes, True, fused,
+                       supersample)
     frame_duration = duration // number
-    seq =[cortex.derive_image(frame)
-          for frame in synth.random_sequence(size, number, mode)]
+    if fused:
+        seq = list(synth.random_sequence(size, number, mode, fused=True,
+                                         supersample=supersample))
+    else:
+        seq =[cortex.derive_image(frame)
+              for frame in synth.random_sequence(size, number, mode)]
     im = seq.pop(0)
     im.save(path, save_all=True, duration=frame_duration, loop=0,
             append_images=seq, comment=im.info["comment"][:255])
@@ -26,9 +33,21 @@ if __name__ == "__main__":
     parser.add_argument("duration", type=int,
         help="duration of image loop in milliseconds")
     parser.add_argument("destination", help="destination path")
+    parser.add_argument("-f", "--fused", action="store_true",
+        help="evaluate waves directly at the mapped coordinates")
+    parser.add_argument("-s", "--supersample", type=limits.positive_int,
+        help="subsamples per pixel along each axis, requires --fused")
+    parser.add_argument("--max-bytes", type=limits.positive_int,
+        help="reject sequences estimated to need more bytes than this")
     args = parser.parse_args()
+    if args.supersample is not None and not args.fused:
+        parser.error("--supersample requires --fused")
     start = time.time()
-    save_random_sequence((args.width, args.height), args.number,
-        args.duration, args.destination)
+    try:
+        save_random_sequence((args.width, args.height), args.number,
+            args.duration, args.destination, fused=args.fused,
+            supersample=args.supersample or 1, max_bytes=args.max_bytes)
+    except ValueError as e:
+        parser.error(str(e))
     end = time.time()
     print(end-start)
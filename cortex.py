@@ -3,6 +3,7 @@
 import math
 import cmath
 import argparse
+from array import array
 from PIL import Image
 
             
@@ -55,6 +56,57 @@ def get_mapped_pixel(size, imdata, derived_coord):
 
 
 
+def max_radius(size):
+    """
+    Return the log of the distance from the centre to a corner of an image
+    of the given size.
+    """
+    return math.log1p(math.sqrt(size[0]**2 + size[1]**2) / 2)
+
+
+def map_coordinate(size, max_r, coord):
+    """
+    Return the coordinate in the source image that the given coordinate in
+    the derived image is taken from.
+    """
+    # max_phi is the constant 2*pi
+    max_phi = 2 * math.pi
+    # convert to polar coords
+    r, phi = cmath.polar(complex(coord[0] - size[0]/2, coord[1] - size[1]/2))
+    if phi < 0:
+        phi = max_phi + phi
+    # map x and y 
+    return ((math.log1p(r)/max_r) * size[0],
+            (phi/max_phi) * size[1])
+
+
+def mapped_grids(size, supersample=1):
+    """
+    Return supersample**2 grids, one per subsample position within a pixel.
+    Each grid is a pair of arrays of x and y coordinates in the range [-1, 1),
+    giving for every pixel of a derived image of the given size, in row order,
+    the normalised point of the source image that the subsample is taken from.
+    """
+    if supersample < 1:
+        raise ValueError("Supersample must be at least 1: %r" % (supersample,))
+    max_r = max_radius(size)
+    offsets = [((i + 0.5) / supersample) - 0.5 for i in range(supersample)]
+    grids = []
+    for y_offset in offsets:
+        for x_offset in offsets:
+            xs = array("d")
+            ys = array("d")
+            for y in range(size[1]):
+                for x in range(size[0]):
+                    u, v = map_coordinate(size, max_r,
+                                          (x + x_offset, y + y_offset))
+                    # map coordinates outside of the image back into the image
+                    xs.append(((u % size[0]) - (size[0]/2)) / (size[0]/2))
+                    ys.append(((v % size[1]) - (size[1]/2)) / (size[1]/2))
+            grids.append((xs, ys))
+    return grids
+
+
 def derive_image(im):
     """
     Return an image derived from a source image by mapping the x axis to
@@ -62,23 +114,13 @@ def derive_image(im):
     """
     im = im.convert("RGB")
     imdata = list(im.getdata())
-    # max_r is the log of the distance from the centre to a corner
-    max_r = math.log1p(math.sqrt(im.size[0]**2 + im.size[1]**2) / 2)
-    # max_phi is the constant 2*pi
-    max_phi = 2 * math.pi
-    phi_step = max_phi / im.size[1]
+    max_r = max_radius(im.size)
     data = []
     # for each pixel in the source image
     for y in range(im.size[1]):
         for x in range(im.size[0]):
-            # convert to polar coords
-            r, phi = cmath.polar(complex(x - im.size[0]/2, y - im.size[1]/2))
-            if phi < 0:
-                phi = max_phi + phi
-            # map x and y 
             data.append(get_mapped_pixel(im.size, imdata,
-                ((math.log1p(r)/max_r) * im.size[0],
-                (phi/max_phi) * im.size[1])))
+                map_coordinate(im.size, max_r, (x, y))))
     dest = Image.new("RGB", im.size)
     dest.putdata(data)
     try:
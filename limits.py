@@ -0,0 +1,63 @@
+import argparse
+
+# approximate size of one entry of a list of floats: pointer plus float object
+LIST_FLOAT_BYTES = 32
+# approximate size of one entry of a list of RGB tuples: pointer plus tuple
+LIST_PIXEL_BYTES = 72
+# Pillow stores multi-channel pixels in four bytes
+IMAGE_PIXEL_BYTES = 4
+
+
+def estimate_bytes(size, number, channels, mapped=False, fused=False,
+                   supersample=1, nodes=0):
+    """
+    Return an estimate of the peak bytes used to produce and hold a sequence
+    of the given number of frames of the given size and number of channels,
+    where nodes is the total size of any nest expressions.
+    """
+    pixels = size[0] * size[1]
+    # every RGB frame is kept until the sequence is saved
+    frames = number * pixels * IMAGE_PIXEL_BYTES
+    # per frame, the channel images, the merged image and a channel's values
+    working = (pixels * (channels + IMAGE_PIXEL_BYTES) +
+               pixels * LIST_FLOAT_BYTES)
+    # a row of values per expression node while a row is evaluated
+    working += size[0] * (nodes + 2) * LIST_FLOAT_BYTES
+    if mapped and fused:
+        # arrays of the fused mapping's coordinates are kept for the sequence
+        working += supersample**2 * 2 * pixels * 8
+    elif mapped:
+        # derive_image holds the source and derived pixels as lists of tuples
+        working += pixels * (2 * LIST_PIXEL_BYTES + IMAGE_PIXEL_BYTES)
+    return frames + working
+
+
+def check_scene(size, number, channels, max_bytes=None, mapped=False,
+                fused=False, supersample=1, nodes=0):
+    """
+    Return the estimated bytes needed by a sequence of the given parameters,
+    raising ValueError if it is empty or the estimate exceeds max_bytes.
+    """
+    if min(size) < 1 or number < 1:
+        raise ValueError("Scene must have at least one pixel and frame")
+    if supersample < 1:
+        raise ValueError("Supersample must be at least 1: %r" % (supersample,))
+    estimate = estimate_bytes(size, number, channels, mapped, fused,
+                              supersample, nodes)
+    if max_bytes is not None and estimate > max_bytes:
+        raise ValueError("Scene needs about %d bytes, limit is %d" %
+                         (estimate, max_bytes))
+    return estimate
+
+
+def positive_int(s):
+    """
+    Parse a command-line integer that must be at least 1.
+    """
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Unable to parse integer: %s" % (s,))
+    if value < 1:
+        raise argparse.ArgumentTypeError("Must be at least 1: %s" % (s,))
+    return value
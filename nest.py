@@ -3,7 +3,9 @@
 import random
 import math
 import cortex
-import sys
+import limits
+import argparse
+from array import array
 from PIL import Image
 from collections import namedtuple
 
@@ -26,6 +28,17 @@ class Variable:
                ((self.phase_direction + self.phase_offset) * 2)) *
                self.frequency) % 2) - 1)
 
+    @classmethod
+    def evaluate_block(cls, operands, variables, phase, phase_direction,
+                       phase_offset, frequency):
+        """
+        Return a list of values for a block of points, where variables holds
+        a sequence of coordinates per dimension.
+        """
+        offset = (phase_direction + phase_offset) * 2
+        return [((((v + 1) + offset) * frequency) % 2) - 1
+                for v in variables[cls.varidx]]
+
     def __str__(self):
         return "{0}(phase={1:.3f}{2}, freq={3:d})".format(
             self.name,
@@ -97,6 +110,16 @@ class TrigfuncPi(Function):
                          self.args[0](variables, phase) *
                          self.frequency) +       
                          self.phase_direction * phase_term)
+
+    @classmethod
+    def evaluate_block(cls, operands, variables, phase, phase_direction,
+                       phase_offset, frequency):
+        phase_term = (phase_direction *
+                      ((2 * math.pi * (phase + phase_offset)) %
+                       (2 * math.pi)))
+        shift = phase_direction * phase_term
+        func = cls.func
+        return [func((math.pi * v * frequency) + shift) for v in operands[0]]
     
 
 class SinPi(TrigfuncPi):
@@ -117,21 +140,132 @@ class Times(Function):
         
     def __call__(self, variables, phase):
         return self.args[0](variables, phase) * self.args[1](variables, phase)
+
+    @classmethod
+    def evaluate_block(cls, operands, variables, phase, phase_direction,
+                       phase_offset, frequency):
+        return [a * b for a, b in zip(*operands)]
         
         
 class Builder:
-    def __init__(self, functions, variables):
+    def __init__(self, functions, variables, max_depth=None, max_nodes=None):
         self.functions = functions
         self.variables = variables
         self.dimensions = len(variables)
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.depth = 0
+        self.nodes = 0
         
     def build(self, probability=0.99, level=0):
-        if random.random() < probability:
-            return random.choice(self.functions).random(probability,
-                                                        level+1,
-                                                        self)
+        """
+        Return a random expression. Functions are not chosen below max_depth,
+        and ValueError is raised as soon as the expression exceeds max_nodes.
+        """
+        if self.depth == 0:
+            self.nodes = 0
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise ValueError(
+                "Expression exceeds %d nodes" % (self.max_nodes,))
+        if ((self.max_depth is None or self.depth < self.max_depth) and
+                random.random() < probability):
+            self.depth += 1
+            try:
+                return random.choice(self.functions).random(probability,
+                                                            level+1,
+                                                            self)
+            finally:
+                self.depth -= 1
         else:
             return random.choice(self.variables).random()
+
+
+# opcodes of the compact representation index into this list
+instructions = [X, Y, SinPi, CosPi, Times]
+
+
+class Program(namedtuple("Program", ["dimensions", "opcodes",
+                                     "phase_directions", "phase_offsets",
+                                     "frequencies"])):
+    """
+    A nested expression flattened into postfix order, one instruction per
+    node, with the node fields held in typed arrays.
+    """
+    __slots__ = ()
+
+    def evaluate_block(self, variables, phase):
+        """
+        Return a list of values of the expression for a block of points,
+        where variables holds a sequence of coordinates per dimension.
+        """
+        stack = []
+        for op, phase_direction, phase_offset, frequency in zip(
+                self.opcodes, self.phase_directions, self.phase_offsets,
+                self.frequencies):
+            cls = instructions[op]
+            if issubclass(cls, Variable):
+                operands = []
+            else:
+                operands = stack[-cls.arity:]
+                del stack[-cls.arity:]
+            stack.append(cls.evaluate_block(operands, variables, phase,
+                                            phase_direction, phase_offset,
+                                            frequency))
+        return stack[0]
+
+    def __call__(self, variables, phase):
+        return self.evaluate_block([[v] for v in variables], phase)[0]
+
+    def __str__(self):
+        return str(expand(self))
+
+
+def compact(expression):
+    """
+    Return a Program holding the given nested expression in postfix order.
+    """
+    if isinstance(expression, Program):
+        return expression
+    nodes = []
+    pending = [expression]
+    # reversed pre-order with children pushed left to right is post-order
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(getattr(node, "args", []))
+    nodes.reverse()
+    try:
+        opcodes = array("B", [instructions.index(node.__class__)
+                              for node in nodes])
+    except ValueError:
+        raise ValueError("Expression contains an unknown node type")
+    dimensions = next((node.dimensions for node in nodes
+                       if hasattr(node, "dimensions")), 2)
+    return Program(dimensions,
+                   opcodes,
+                   array("b", [node.phase_direction for node in nodes]),
+                   array("d", [node.phase_offset for node in nodes]),
+                   array("I", [node.frequency for node in nodes]))
+
+
+def expand(program):
+    """
+    Return the nested expression held by the given Program.
+    """
+    stack = []
+    for op, phase_direction, phase_offset, frequency in zip(
+            program.opcodes, program.phase_directions, program.phase_offsets,
+            program.frequencies):
+        cls = instructions[op]
+        if issubclass(cls, Variable):
+            stack.append(cls(phase_direction, phase_offset, frequency))
+        else:
+            args = stack[-cls.arity:]
+            del stack[-cls.arity:]
+            stack.append(cls(args, program.dimensions, phase_direction,
+                             phase_offset, frequency))
+    return stack[0]
             
             
 phase_adjustments = [
@@ -144,39 +278,55 @@ phase_adjustments = [
 
 functions = [SinPi, CosPi, Times]
 
-def create_image(size, expression, phase=0):
+def create_image(size, expression, phase=0, grids=None):
     """
     Return an image of the given size plotting intensity of the given
     nested function of frequency and phase, with x and y mapped by prefunc.
+    The expression is evaluated a row at a time in its compact form. If grids
+    from cortex.mapped_grids are given, the expression is instead evaluated
+    at those coordinates and the subsamples averaged for each pixel.
     """
+    program = compact(expression)
     data = []
-    for y in range(size[1]):
-        for x in range(size[0]):
-            x1,y1 = ((x - (size[0]/2)) / (size[0]/2),
-                     (y - (size[1]/2)) / (size[1]/2))
-            data.append(
-                int(expression([x1,y1], phase) * 127.5) + 127.5)
+    if grids is not None:
+        for start in range(0, size[0] * size[1], size[0]):
+            totals = [0] * size[0]
+            for xs, ys in grids:
+                values = program.evaluate_block(
+                    [xs[start:start + size[0]], ys[start:start + size[0]]],
+                    phase)
+                totals = [t + v for t, v in zip(totals, values)]
+            data.extend(int((t / len(grids)) * 127.5) + 127.5
+                        for t in totals)
+    else:
+        xs = [(x - (size[0]/2)) / (size[0]/2) for x in range(size[0])]
+        for y in range(size[1]):
+            y1 = (y - (size[1]/2)) / (size[1]/2)
+            data.extend(int(v * 127.5) + 127.5
+                        for v in program.evaluate_block([xs, [y1] * size[0]],
+                                                        phase))
     dest = Image.new("L", size)
     dest.putdata(data)
     return dest
 
-def generate_greyscale_image(size, expression, phase, phase_adjust):
+def generate_greyscale_image(size, expression, phase, phase_adjust,
+                             grids=None):
     """
     Return an image of the given size plotting the given function called with
     the given arguments.
     """
-    return create_image(size, expression, phase_adjust(phase))
+    return create_image(size, expression, phase_adjust(phase), grids)
  
 GreyscaleArgs = namedtuple("GreyscaleArgs",
                            ["size", "expression", "phase"])
     
-def random_greyscale_args(size):
+def random_greyscale_args(size, max_depth=None, max_nodes=None):
     """
     Return a GreyscaleArgs tuple with the given size and randomly chosen
-    values.
+    values, with the expression limited to max_depth and max_nodes.
     """
-    expression = Builder(functions, [X,Y]).build(
-                                        probability=random.uniform(0.95,0.99))
+    builder = Builder(functions, [X,Y], max_depth, max_nodes)
+    expression = compact(builder.build(probability=random.uniform(0.95,0.99)))
     
     phase = random.random()
     return GreyscaleArgs(size, expression, phase)
@@ -211,29 +361,43 @@ def random_image(size, mode=None):
             im = im.convert("RGB")
         return im
     
-def random_sequence(size, number, mode=None):
+def random_sequence(size, number, mode=None, fused=False, supersample=1,
+                    max_depth=None, max_nodes=None, max_bytes=None):
     """
     Yield Image objects of given size and mode in a sequence with length given
     by number. The phase is varied producing a sequence that should loop. The
-    wave arguments for each channel are random.
+    wave arguments for each channel are random. ValueError is raised before
+    any frame is rendered if an expression exceeds max_nodes or the sequence
+    is estimated to need more than max_bytes.
     """
     if mode is None:
         mode = random.choice(list(modes.keys()))
     number_of_channels = modes[mode]   
-    channel_args = [random_greyscale_args(size)
+    channel_args = [random_greyscale_args(size, max_depth, max_nodes)
                     for _ in range(number_of_channels)]
     phase_adjusts = [random.choice(phase_adjustments)
                      for _ in range(number_of_channels)]
     mapped = random.choice([True, False])
+    limits.check_scene(size, number, number_of_channels, max_bytes, mapped,
+                       fused, supersample,
+                       sum(len(args.expression.opcodes)
+                           for args in channel_args))
     yield from create_sequence(size, number, mode, channel_args, phase_adjusts,
-                               mapped)
+                               mapped, fused, supersample)
                     
-def create_sequence(size, number, mode, channel_args, phase_adjusts, mapped):
+def create_sequence(size, number, mode, channel_args, phase_adjusts, mapped,
+                    fused=False, supersample=1):
     """
     Yield Image objects of given size and mode in a sequence with length given
     by number. The phase is varied producing a sequence that should loop. The
-    wave arguments for each channel are provided by channel_args.
+    wave arguments for each channel are provided by channel_args. If mapped
+    and fused, each frame is evaluated directly at the coordinates used by
+    cortex.derive_image with supersample**2 subsamples per pixel, rather than
+    rendered and then resampled; supersample is ignored otherwise.
     """
+    grids = None
+    if mapped and fused:
+        grids = cortex.mapped_grids(size, supersample)
     number_of_channels = len(channel_args)
     phase_dir = [random.choice([-1,1]) for _ in range(len(channel_args))]
     info = [mode]
@@ -249,28 +413,55 @@ def create_sequence(size, number, mode, channel_args, phase_adjusts, mapped):
         channels = [generate_greyscale_image(
                     *channel_args[i][:-1] +
                      (channel_args[i][-1] + (phase*phase_dir[i]) % 1,
-                      phase_adjusts[i]))    
+                      phase_adjusts[i], grids))
                     for i in range(number_of_channels)]
         merged = Image.merge(mode, channels).convert("RGB")
-        if mapped:
+        if mapped and not fused:
             merged = cortex.derive_image(merged)
         merged.info["comment"] = "\n".join(info).encode()
         yield merged
 
-def save_random_sequence(size, number, duration, path, mode=None):
+def save_random_sequence(size, number, duration, path, mode=None, fused=False,
+                         supersample=1, max_depth=None, max_nodes=None,
+                         max_bytes=None):
     if mode is None:
         mode = random.choice(["RGB", "HSV", "YCbCr", "CMYK"])
+    seq = [frame for frame in random_sequence(size, number, mode, fused,
+                                              supersample, max_depth,
+                                              max_nodes, max_bytes)]
     frame_duration = duration // number
-    seq = [frame for frame in random_sequence(size, number, mode)]
     print(len(seq))
     im = seq.pop(0)
     im.save(path, save_all=True, duration=frame_duration, loop=0,
             append_images=seq, comment=im.info["comment"][:255])
 
 if __name__ == "__main__":
-    size = [int(sys.argv[1]), int(sys.argv[2])]
-    number = int(sys.argv[3])
-    duration = int(sys.argv[4])
-    path = sys.argv[5]
-    save_random_sequence(size, number, duration, path)
+    parser = argparse.ArgumentParser(
+        description="Create animations of random nested functions.")
+    parser.add_argument("width", type=int, help="width in pixels")
+    parser.add_argument("height", type=int, help="height in pixels")
+    parser.add_argument("number", type=int, help="number of frames")
+    parser.add_argument("duration", type=int,
+        help="duration of image loop in milliseconds")
+    parser.add_argument("destination", help="destination path")
+    parser.add_argument("-f", "--fused", action="store_true",
+        help="evaluate mapped frames directly at the mapped coordinates")
+    parser.add_argument("-s", "--supersample", type=limits.positive_int,
+        help="subsamples per pixel along each axis, requires --fused")
+    parser.add_argument("--max-depth", type=limits.positive_int,
+        help="maximum depth of each expression")
+    parser.add_argument("--max-nodes", type=limits.positive_int,
+        help="reject expressions with more nodes than this")
+    parser.add_argument("--max-bytes", type=limits.positive_int,
+        help="reject sequences estimated to need more bytes than this")
+    args = parser.parse_args()
+    if args.supersample is not None and not args.fused:
+        parser.error("--supersample requires --fused")
+    try:
+        save_random_sequence([args.width, args.height], args.number,
+            args.duration, args.destination, fused=args.fused,
+            supersample=args.supersample or 1, max_depth=args.max_depth,
+            max_nodes=args.max_nodes, max_bytes=args.max_bytes)
+    except ValueError as e:
+        parser.error(str(e))
     
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import sys
+import csv
+import time
+import random
+import argparse
+import resource
+import multiprocessing
+from collections import namedtuple
+import nest
+import synth
+import cortex
+import limits
+
+# frames are left unmapped, rendered then mapped by cortex.derive_image, or
+# evaluated directly at the mapped coordinates
+mappings = ["none", "derive", "fused"]
+
+Limits = namedtuple("Limits", ["max_nodes", "max_bytes"])
+
+Result = namedtuple("Result",
+                    ["generator", "width", "height", "number", "mode",
+                     "mapping", "depth", "nodes", "estimate_bytes", "seconds",
+                     "rss_bytes", "status"])
+
+
+def random_channel_args(generator, size, mode, depth, scene_limits):
+    """
+    Return a list of random GreyscaleArgs, one per channel of the given mode,
+    with nest expressions limited to the given depth and node count.
+    """
+    if generator == "synth":
+        return [synth.random_greyscale_args(size)
+                for _ in range(synth.modes[mode])]
+    return [nest.random_greyscale_args(size, depth, scene_limits.max_nodes)
+            for _ in range(nest.modes[mode])]
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure_scene(conn, generator, size, number, mode, mapping, depth,
+                  scene_limits, supersample):
+    """
+    Produce a random sequence with the given parameters and send a Result
+    recording its time and growth in peak resident set size, or why it was
+    rejected, through conn. The mapping is one of mappings.
+    """
+    mapped = mapping != "none"
+    fused = mapping == "fused"
+    nodes = ""
+    estimate = ""
+    baseline = peak_rss()
+    start = time.perf_counter()
+    try:
+        channel_args = random_channel_args(generator, size, mode, depth,
+                                           scene_limits)
+        if generator == "nest":
+            nodes = sum(len(args.expression.opcodes) for args in channel_args)
+        estimate = limits.check_scene(size, number, len(channel_args),
+                                      scene_limits.max_bytes, mapped, fused,
+                                      supersample, nodes or 0)
+        if generator == "synth":
+            seq = list(synth.create_sequence(size, number, mode, channel_args,
+                                             None, fused=fused,
+                                             supersample=supersample))
+            if mapped and not fused:
+                seq = [cortex.derive_image(frame) for frame in seq]
+        else:
+            phase_adjusts = [random.choice(nest.phase_adjustments)
+                             for _ in channel_args]
+            seq = list(nest.create_sequence(size, number, mode, channel_args,
+                                            phase_adjusts, mapped,
+                                            fused=fused,
+                                            supersample=supersample))
+        status = "ok"
+    except ValueError as e:
+        status = "rejected: %s" % (e,)
+    seconds = round(time.perf_counter() - start, 4)
+    conn.send(Result(generator, size[0], size[1], number, mode, mapping,
+                     depth if generator == "nest" else "", nodes, estimate,
+                     seconds, peak_rss() - baseline, status))
+    conn.close()
+
+
+def run_scene(generator, size, number, mode, mapping, depth, scene_limits,
+              supersample=1):
+    """
+    Return the Result of measuring a scene in a fresh worker process, so that
+    memory held by Pillow is counted and a scene that kills its worker is
+    recorded as failed.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    worker = context.Process(target=measure_scene,
+                             args=(sender, generator, size, number, mode,
+                                   mapping, depth, scene_limits, supersample))
+    worker.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        worker.join()
+        result = Result(generator, size[0], size[1], number, mode, mapping,
+                        depth if generator == "nest" else "", "", "", "", "",
+                        "failed: worker exit code %s" % (worker.exitcode,))
+    worker.join()
+    return result
+
+
+def sweep(generator, sizes, numbers, modes, mappings, depths, scene_limits,
+          supersample=1):
+    """
+    Yield a Result for every combination of the given sizes, frame numbers,
+    modes, mappings and tree depths.
+    """
+    if generator == "synth":
+        depths = [None]
+    for size in sizes:
+        for number in numbers:
+            for mode in modes:
+                for mapping in mappings:
+                    for depth in depths:
+                        yield run_scene(generator, size, number, mode,
+                                        mapping, depth, scene_limits,
+                                        supersample)
+
+
+def parse_size(s):
+    """
+    Parse a WIDTHxHEIGHT command-line size and return a (width, height)
+    tuple.
+    """
+    try:
+        width, height = (int(v) for v in s.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Unable to parse size: %s" % (s,))
+    return (width, height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time random sequences over a sweep of scene parameters.")
+    parser.add_argument("-g", "--generator", choices=["nest", "synth"],
+        default="nest", help="image generator")
+    parser.add_argument("-s", "--sizes", type=parse_size, nargs="+",
+        default=[(8, 8), (32, 32), (64, 64)], help="WIDTHxHEIGHT sizes")
+    parser.add_argument("-n", "--numbers", type=limits.positive_int, nargs="+",
+        default=[1, 4, 16], help="numbers of frames")
+    parser.add_argument("-m", "--modes", nargs="+",
+        choices=list(synth.modes.keys()), default=["RGB"], help="image modes")
+    parser.add_argument("-d", "--depths", type=limits.positive_int, nargs="+",
+        default=[2, 4, 8], help="maximum nest expression depths")
+    parser.add_argument("--mappings", nargs="+", choices=mappings,
+        default=["none"],
+        help="unmapped frames, frames mapped with derive_image, or frames "
+             "evaluated at the mapped coordinates")
+    parser.add_argument("--supersample", type=limits.positive_int,
+        help="subsamples per pixel along each axis, requires fused mapping")
+    parser.add_argument("--max-nodes", type=limits.positive_int,
+        help="reject nest expressions with more nodes than this")
+    parser.add_argument("--max-bytes", type=limits.positive_int,
+        help="reject scenes estimated to need more bytes than this")
+    args = parser.parse_args()
+    if args.supersample is not None and "fused" not in args.mappings:
+        parser.error("--supersample requires fused mapping")
+    scene_limits = Limits(args.max_nodes, args.max_bytes)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(Result._fields)
+    for result in sweep(args.generator, args.sizes, args.numbers, args.modes,
+                        args.mappings, args.depths, scene_limits,
+                        args.supersample or 1):
+        writer.writerow(result)
+        sys.stdout.flush()
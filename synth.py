@@ -4,17 +4,32 @@ import math
 import random
 import argparse
 import os.path
+import cortex
+import limits
 from PIL import Image
 from collections import namedtuple
 
-def create_image(size, func, prefunc=None, freq=1, phase=0):
+def create_image(size, func, prefunc=None, freq=1, phase=0, grids=None):
     """
     Return an image of the given size plotting intensity of the given
-    function of frequency and phase, with x and y mapped by prefunc.
+    function of frequency and phase, with x and y mapped by prefunc. If grids
+    from cortex.mapped_grids are given, the function is evaluated at those
+    coordinates and the subsamples averaged for each pixel.
     """
     data = []
     if prefunc is None:
         prefunc = lambda x,y: (x,y)
+    if grids is not None:
+        for start in range(0, size[0] * size[1], size[0]):
+            totals = [0] * size[0]
+            for xs, ys in grids:
+                for i in range(size[0]):
+                    totals[i] += func(*prefunc(xs[start + i], ys[start + i]),
+                                      freq, phase)
+            data.extend(((t / len(grids)) * 127.5) + 127.5 for t in totals)
+        dest = Image.new("L", size)
+        dest.putdata(data)
+        return dest
     for y in range(size[1]):
         for x in range(size[0]):
             x1,y1 = prefunc((x - (size[0]/2)) / (size[0]/2),
@@ -71,12 +86,13 @@ functions = {f.__name__: f for f in [
                                 (sawtooth, 1)]]}
 
 
-def generate_greyscale_image(size, func, freq, prefunc, phase, phase_adjust):
+def generate_greyscale_image(size, func, freq, prefunc, phase, phase_adjust,
+                             grids=None):
     """
     Return an image of the given size plotting the given function called with
     the given arguments.
     """
-    return create_image(size, func, prefunc, freq, phase_adjust(phase))
+    return create_image(size, func, prefunc, freq, phase_adjust(phase), grids)
  
 GreyscaleArgs = namedtuple("GreyscaleArgs",
                            ["size", "func", "freq", "prefunc", "phase"])
@@ -88,7 +104,7 @@ def random_greyscale_args(size):
     """
     func = functions[random.choice(list(functions.keys()))]
     axis = func.axis
-    freq = random.randrange(1,min([64,round(min(size)/8)]))
+    freq = random.randrange(1,max([2,min([64,round(min(size)/8)])]))
     prefunc = (shear_m(random.randrange(0,freq+1) *
                random.choice([-1,1]), axis))
     phase = random.random()
@@ -134,27 +150,40 @@ def random_image(size, mode=None):
             im = im.convert("RGB")
         return im
     
-def random_sequence(size, number, mode=None):
+def random_sequence(size, number, mode=None, fused=False, supersample=1,
+                    max_bytes=None):
     """
     Yield Image objects of given size and mode in a sequence with length given
     by number. The phase is varied producing a sequence that should loop. The
-    wave arguments for each channel are random.
+    wave arguments for each channel are random. ValueError is raised before
+    any frame is rendered if the sequence is estimated to need more than
+    max_bytes.
     """
     if mode is None:
         mode = random.choice(list(modes.keys()))
     number_of_channels = modes[mode]
+    limits.check_scene(size, number, number_of_channels, max_bytes, fused,
+                       fused, supersample)
     phase_adjusts = [random.choice(phase_adjustments)
                      for _ in range(number_of_channels)]
     channel_args = [random_greyscale_args(size)
                     for _ in range(number_of_channels)]
-    yield from create_sequence(size, number, mode, channel_args, phase_adjusts)
+    yield from create_sequence(size, number, mode, channel_args, phase_adjusts,
+                               fused, supersample)
                     
-def create_sequence(size, number, mode, channel_args, phase_adjusts=None):
+def create_sequence(size, number, mode, channel_args, phase_adjusts=None,
+                    fused=False, supersample=1):
     """
     Yield Image objects of given size and mode in a sequence with length given
     by number. The phase is varied producing a sequence that should loop. The
-    wave arguments for each channel are provided by channel_args.
+    wave arguments for each channel are provided by channel_args. If fused,
+    each frame is evaluated directly at the coordinates used by
+    cortex.derive_image with supersample**2 subsamples per pixel; supersample
+    is ignored otherwise.
     """
+    grids = None
+    if fused:
+        grids = cortex.mapped_grids(size, supersample)
     number_of_channels = len(channel_args)
     if phase_adjusts is None:
         phase_adjusts = [(lambda p: p) for _ in range(number_of_channels)]
@@ -172,7 +201,7 @@ def create_sequence(size, number, mode, channel_args, phase_adjusts=None):
         channels = [generate_greyscale_image(
                      *channel_args[i][:-1] +
                      (channel_args[i][-1] + (phase*phase_dir[i]) % 1,
-                      phase_adjusts[i]))
+                      phase_adjusts[i], grids))
                     for i in range(number_of_channels)]
         merged = Image.merge(mode, channels).convert("RGB")
         merged.info["comment"] = "\n".join(info).encode()
@@ -230,8 +259,10 @@ if __name__ == "__main__":
         type=parse_spec,
         help="list of func,freq,shear,phase;[...] arguments per channel ")
     parser.add_argument("-n", "--number",
-        type=int,
+        type=limits.positive_int,
         help="number of images to produce in a sequence")
+    parser.add_argument("--max-bytes", type=limits.positive_int,
+        help="reject images estimated to need more bytes than this")
     args = parser.parse_args()
     if args.spec:
         if args.mode is None:
@@ -245,6 +276,12 @@ if __name__ == "__main__":
         if len(args.spec) != channels:
             raise argparse.ArgumentTypeError(
                 "Wrong number of channels in spec for mode %s" % (args.mode,))
+        try:
+            limits.check_scene((args.width, args.height),
+                               1 if args.number is None else args.number,
+                               channels, args.max_bytes)
+        except ValueError as e:
+            parser.error(str(e))
         greyscale_args = []
         for spec in args.spec:
             greyscale_args.append(GreyscaleArgs(
@@ -283,6 +320,12 @@ if __name__ == "__main__":
             mode = random.choice(["RGB", "HSV", "YCbCr", "CMYK"])
         else:
             mode = args.mode
+        try:
+            limits.check_scene((args.width, args.height),
+                               1 if args.number is None else args.number,
+                               modes.get(mode, 1), args.max_bytes)
+        except ValueError as e:
+            parser.error(str(e))
         if args.number is not None:
             if os.path.splitext(args.destination)[1] == ".gif":
                 seq = []